@@ -12,6 +12,7 @@ import users
 import transfer
 import zoobarjs
 import zoodb
+import admission
 from debug import catch_err
 
 app = Flask(__name__)
@@ -35,5 +36,7 @@ def disable_xss_protection(response):
     response.headers.add("X-XSS-Protection", "0")
     return response
 
+app.wsgi_app = admission.AdmissionControl(app.wsgi_app) # type: ignore[method-assign]
+
 if __name__ == "__main__":
     app.run()
@@ -0,0 +1,377 @@
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from werkzeug.wsgi import ClosingIterator
+
+from debug import log
+
+## WSGI middleware that sits in front of the Flask app and decides whether a
+## request gets to run at all.  Each endpoint class has its own concurrency
+## limit and bounded wait queue, so a burst of expensive /users lookups or
+## logins cannot use up every worker and starve the cheap pages.
+##
+## zookd runs a fresh index.cgi process for every request, so all of the
+## state (running/waiting slots, login token buckets, counters) lives in a
+## small sqlite database next to the person and transfer databases.
+##
+## The lab's zookd does not set REMOTE_ADDR; login rate limiting only kicks
+## in behind a server that does.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS slot (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    class TEXT NOT NULL,
+    pid INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    since REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS bucket (
+    client TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    last REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS bucket_last ON bucket (last);
+CREATE TABLE IF NOT EXISTS stat (
+    class TEXT PRIMARY KEY,
+    admitted INTEGER NOT NULL DEFAULT 0,
+    queued INTEGER NOT NULL DEFAULT 0,
+    dequeued INTEGER NOT NULL DEFAULT 0,
+    shed_queue_full INTEGER NOT NULL DEFAULT 0,
+    shed_deadline INTEGER NOT NULL DEFAULT 0,
+    rate_limited INTEGER NOT NULL DEFAULT 0,
+    no_client INTEGER NOT NULL DEFAULT 0,
+    wait_total REAL NOT NULL DEFAULT 0,
+    wait_max REAL NOT NULL DEFAULT 0
+);
+"""
+
+STAT_COUNTERS = ('admitted', 'queued', 'dequeued', 'shed_queue_full',
+                 'shed_deadline', 'rate_limited', 'no_client')
+
+## How often a queued request re-checks for a free slot, in seconds.
+POLL_INTERVAL = 0.01
+
+def admission_setup(timeout: float = 5.0) -> sqlite3.Connection:
+    thisdir = os.path.dirname(os.path.abspath(__file__))
+    dbdir   = os.path.join(thisdir, "db", "admission")
+    ## Several CGI processes may race to create it.
+    os.makedirs(dbdir, exist_ok=True)
+
+    dbfile  = os.path.join(dbdir, "admission.db")
+    ## timeout bounds how long any statement waits for the database lock.
+    db = sqlite3.connect(dbfile, timeout=timeout, isolation_level=None)
+    db.executescript(SCHEMA)
+    return db
+
+@contextmanager
+def transaction(db: sqlite3.Connection) -> Iterator[None]:
+    ## IMMEDIATE takes the write lock up front, so two processes cannot both
+    ## see a free slot and both take it.
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+    db.execute("COMMIT")
+
+def set_lock_timeout(db: sqlite3.Connection, seconds: float) -> None:
+    db.execute("PRAGMA busy_timeout = %d" % max(1, int(seconds * 1000)))
+
+def bump(db: sqlite3.Connection, name: str, counter: str) -> int:
+    assert counter in STAT_COUNTERS
+    db.execute("INSERT OR IGNORE INTO stat (class) VALUES (?)", (name,))
+    db.execute("UPDATE stat SET %s = %s + 1 WHERE class = ?" % (counter, counter),
+               (name,))
+    (n,) = db.execute("SELECT %s FROM stat WHERE class = ?" % counter,
+                      (name,)).fetchone()
+    return int(n)
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def purge_dead(db: sqlite3.Connection) -> None:
+    ## A CGI process that crashed or was killed never released its slot.
+    for (pid,) in db.execute("SELECT DISTINCT pid FROM slot").fetchall():
+        if not pid_alive(pid):
+            db.execute("DELETE FROM slot WHERE pid = ?", (pid,))
+
+class Shed(Exception):
+    pass
+
+class RateLimited(Exception):
+    def __init__(self, client: str, retry_after: int) -> None:
+        super().__init__(client)
+        self.retry_after = retry_after
+
+class EndpointClass(object):
+    def __init__(self, name: str, concurrency: int, queue: int,
+                 deadline: float) -> None:
+        self.name = name
+        self.concurrency = concurrency
+        self.queue = queue
+        self.deadline = deadline
+
+    def count(self, db: sqlite3.Connection, state: str) -> int:
+        (n,) = db.execute("SELECT COUNT(*) FROM slot WHERE class = ? AND state = ?",
+                          (self.name, state)).fetchone()
+        return int(n)
+
+    def admit(self, db: sqlite3.Connection, waited: float) -> None:
+        bump(db, self.name, 'admitted')
+        if waited > 0:
+            bump(db, self.name, 'dequeued')
+        db.execute("UPDATE stat SET wait_total = wait_total + ?,"
+                   " wait_max = MAX(wait_max, ?) WHERE class = ?",
+                   (waited, waited, self.name))
+
+    def acquire(self, db: sqlite3.Connection) -> Tuple[int, float]:
+        """Wait for a slot; return (slot id, seconds queued), or raise Shed."""
+        start = time.time()
+        try:
+            (slot, waited) = self.enter(db, start)
+        except sqlite3.OperationalError as e:
+            ## Could not get the database lock before the deadline.
+            raise Shed("database busy: %s" % e)
+
+        try:
+            while waited is None:
+                time.sleep(POLL_INTERVAL)
+                ## Never block on the lock past this request's deadline.
+                set_lock_timeout(db, start + self.deadline - time.time())
+                waited = self.poll(db, slot, start)
+            set_lock_timeout(db, self.deadline)
+        except sqlite3.OperationalError as e:
+            try:
+                self.release(db, slot)
+            except sqlite3.OperationalError:
+                ## purge_dead drops the row once this process is gone.
+                pass
+            raise Shed("database busy: %s" % e)
+        return (slot, waited)
+
+    def enter(self, db: sqlite3.Connection,
+              start: float) -> Tuple[int, Optional[float]]:
+        """Take a slot or join the queue; waited is None while queued."""
+        with transaction(db):
+            purge_dead(db)
+            if (self.count(db, 'running') < self.concurrency and
+                self.count(db, 'waiting') == 0):
+                slot = db.execute("INSERT INTO slot (class, pid, state, since)"
+                                  " VALUES (?, ?, 'running', ?)",
+                                  (self.name, os.getpid(), start)).lastrowid
+                assert slot is not None
+                self.admit(db, 0.0)
+                return (slot, 0.0)
+            if self.count(db, 'waiting') >= self.queue:
+                bump(db, self.name, 'shed_queue_full')
+            else:
+                slot = db.execute("INSERT INTO slot (class, pid, state, since)"
+                                  " VALUES (?, ?, 'waiting', ?)",
+                                  (self.name, os.getpid(), start)).lastrowid
+                assert slot is not None
+                bump(db, self.name, 'queued')
+                return (slot, None)
+        raise Shed("queue full")
+
+    def poll(self, db: sqlite3.Connection, slot: int,
+             start: float) -> Optional[float]:
+        """Move a queued slot to running if it is our turn."""
+        reason = None
+        with transaction(db):
+            purge_dead(db)
+            waited = time.time() - start
+            (ahead,) = db.execute("SELECT COUNT(*) FROM slot WHERE class = ?"
+                                  " AND state = 'waiting' AND id < ?",
+                                  (self.name, slot)).fetchone()
+            if self.count(db, 'running') < self.concurrency and ahead == 0:
+                db.execute("UPDATE slot SET state = 'running' WHERE id = ?",
+                           (slot,))
+                self.admit(db, waited)
+                return waited
+            if waited >= self.deadline:
+                db.execute("DELETE FROM slot WHERE id = ?", (slot,))
+                bump(db, self.name, 'shed_deadline')
+                reason = "queue deadline"
+        if reason is not None:
+            raise Shed(reason)
+        return None
+
+    def release(self, db: sqlite3.Connection, slot: int) -> None:
+        with transaction(db):
+            db.execute("DELETE FROM slot WHERE id = ?", (slot,))
+
+class RateLimiter(object):
+    """Token bucket per client address."""
+
+    def __init__(self, name: str, rate: float, burst: int) -> None:
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+
+    def check(self, db: sqlite3.Connection, client: str) -> Optional[float]:
+        """Take a token for client; return None if allowed, else seconds to wait."""
+        try:
+            return self.take(db, client)
+        except sqlite3.OperationalError as e:
+            raise Shed("database busy: %s" % e)
+
+    def take(self, db: sqlite3.Connection, client: str) -> Optional[float]:
+        now = time.time()
+        with transaction(db):
+            ## A bucket idle this long has refilled completely, which is the
+            ## same as having no bucket at all.
+            db.execute("DELETE FROM bucket WHERE last < ?",
+                       (now - self.burst / self.rate,))
+            row = db.execute("SELECT tokens, last FROM bucket WHERE client = ?",
+                             (client,)).fetchone()
+            tokens, last = row if row else (float(self.burst), now)
+            tokens = min(float(self.burst), tokens + (now - last) * self.rate)
+            if tokens >= 1.0:
+                wait = None
+                tokens -= 1.0
+            else:
+                wait = (1.0 - tokens) / self.rate
+                bump(db, self.name, 'rate_limited')
+            db.execute("INSERT OR REPLACE INTO bucket (client, tokens, last)"
+                       " VALUES (?, ?, ?)", (client, tokens, now))
+        return wait
+
+## Path prefix -> (concurrency, queue length, queue deadline in seconds).
+## Anything that does not match falls into "default".
+DEFAULT_CLASSES = {
+    'login':    ('/login', 2, 8, 2.0),
+    'users':    ('/users', 2, 4, 1.0),
+    'transfer': ('/transfer', 4, 8, 2.0),
+    'default':  ('', 8, 16, 1.0),
+}
+
+def stats(db: sqlite3.Connection) -> Dict[str, Dict[str, Any]]:
+    r: Dict[str, Dict[str, Any]] = {}
+    for row in db.execute("SELECT class, %s, wait_total, wait_max FROM stat" %
+                          ", ".join(STAT_COUNTERS)):
+        s = dict(zip(STAT_COUNTERS, row[1:-2]))
+        ## Average over the queued requests that were eventually admitted.
+        s['wait_avg'] = row[-2] / s['dequeued'] if s['dequeued'] else 0.0
+        s['wait_max'] = row[-1]
+        r[row[0]] = s
+    for name, state, n in db.execute("SELECT class, state, COUNT(*) FROM slot"
+                                      " GROUP BY class, state"):
+        r.setdefault(name, {})[state] = n
+    return r
+
+def report(db: sqlite3.Connection, name: str) -> Dict[str, Any]:
+    ## Only for log lines, so a busy database is not worth failing over.
+    try:
+        return stats(db).get(name, {})
+    except sqlite3.OperationalError:
+        return {}
+
+class AdmissionControl(object):
+    def __init__(self, app: Callable[..., Any],
+                 classes: Dict[str, Tuple[str, int, int, float]] = DEFAULT_CLASSES,
+                 login_rate: float = 1.0, login_burst: int = 5,
+                 retry_after: int = 1) -> None:
+        self.app = app
+        self.retry_after = retry_after
+        self.prefixes: List[Tuple[str, EndpointClass]] = []
+        self.classes: Dict[str, EndpointClass] = {}
+        for name, (prefix, concurrency, queue, deadline) in classes.items():
+            ec = EndpointClass(name, concurrency, queue, deadline)
+            self.classes[name] = ec
+            self.prefixes.append((prefix, ec))
+        ## Longest prefix first, so "" (default) is tried last.
+        self.prefixes.sort(key=lambda p: len(p[0]), reverse=True)
+        self.login_limiter = RateLimiter('login', login_rate, login_burst)
+
+    def classify(self, path: str) -> EndpointClass:
+        for prefix, ec in self.prefixes:
+            if path.startswith(prefix):
+                return ec
+        return self.classes['default']
+
+    def reject(self, start_response: Callable[..., Any], status: str,
+               retry_after: int) -> Iterable[bytes]:
+        body = status.encode('utf-8')
+        start_response(status, [('Content-Type', 'text/plain'),
+                                ('Content-Length', str(len(body))),
+                                ('Retry-After', str(retry_after))])
+        return [body]
+
+    def __call__(self, environ: Dict[str, Any],
+                 start_response: Callable[..., Any]) -> Iterable[bytes]:
+        path = environ.get('PATH_INFO', '')
+        ec = self.classify(path)
+        try:
+            db = admission_setup(ec.deadline)
+        except sqlite3.OperationalError as e:
+            log("shed %s request (database busy: %s)" % (ec.name, e))
+            return self.reject(start_response, '503 Service Unavailable',
+                               self.retry_after)
+
+        try:
+            if ec.name == 'login' and environ.get('REQUEST_METHOD') == 'POST':
+                self.limit_login(db, environ.get('REMOTE_ADDR'))
+            (slot, waited) = ec.acquire(db)
+        except RateLimited as e:
+            log("rate limited login from %s: %s" % (e, report(db, ec.name)))
+            db.close()
+            return self.reject(start_response, '429 Too Many Requests',
+                               e.retry_after)
+        except Shed as e:
+            log("shed %s request (%s): %s" % (ec.name, e, report(db, ec.name)))
+            db.close()
+            return self.reject(start_response, '503 Service Unavailable',
+                               self.retry_after)
+        if waited > 0:
+            log("%s request queued %.3fs: %s" % (ec.name, waited, report(db, ec.name)))
+
+        def done() -> None:
+            try:
+                ec.release(db, slot)
+            except sqlite3.OperationalError as e:
+                log("could not release %s slot, leaving it to purge_dead: %s" %
+                    (ec.name, e))
+            db.close()
+
+        ## Hold the slot until the server has finished with the body, which
+        ## matters for streamed and send_file responses.
+        try:
+            app_iter = self.app(environ, start_response)
+        except BaseException:
+            done()
+            raise
+        return ClosingIterator(app_iter, done)
+
+    def limit_login(self, db: sqlite3.Connection, client: Optional[str]) -> None:
+        if not client:
+            ## Without a client address every request would share one bucket,
+            ## and one client could lock everybody else out of logging in.
+            try:
+                with transaction(db):
+                    first = bump(db, self.login_limiter.name, 'no_client') == 1
+            except sqlite3.OperationalError as e:
+                raise Shed("database busy: %s" % e)
+            if first:
+                log("no REMOTE_ADDR from the server; login rate limiting is off")
+            return
+        wait = self.login_limiter.check(db, client)
+        if wait is not None:
+            raise RateLimited(client, int(wait) + 1)
+
+def main() -> None:
+    db = admission_setup()
+    for name, s in sorted(stats(db).items()):
+        print("%-10s %s" % (name, " ".join("%s=%s" % kv for kv in sorted(s.items()))))
+
+if __name__ == "__main__":
+    main()
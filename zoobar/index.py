@@ -1,4 +1,4 @@
-from flask import g, render_template, request
+from flask import g, redirect, render_template, request, url_for
 from login import requirelogin
 from debug import *
 from zoodb import *
@@ -6,12 +6,13 @@ from zoodb import *
 @catch_err
 @requirelogin
 def index():
+    persondb = person_setup()
+    person = persondb.query(Person).options(undefer(Person.profile)).get(
+        g.user.person.username)
+    if person is None:
+        ## The account went away after requirelogin checked the cookie.
+        return redirect(url_for('logout'))
     if 'profile_update' in request.form:
-        persondb = person_setup()
-        person = persondb.query(Person).get(g.user.person.username)
         person.profile = request.form['profile_update']
         persondb.commit()
-
-        ## also update the cached version (see login.py)
-        g.user.person.profile = person.profile
-    return render_template('index.html')
+    return render_template('index.html', profile=person.profile)
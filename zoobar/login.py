@@ -2,15 +2,27 @@ from flask import g, redirect, render_template, request, url_for, Markup, Respon
 from functools import wraps
 from debug import *
 from zoodb import *
-from typing import Optional
+from typing import NamedTuple, Optional
 
 import auth
 import bank
 import random
 
+## Plain data, detached from any session.  Views that need the (deferred)
+## profile load it themselves; see index.py.
+class PersonRecord(NamedTuple):
+    username: str
+
+class UserRecord(NamedTuple):
+    person: Optional[PersonRecord]
+    token: Optional[str]
+    zoobars: int
+
 class User(object):
     def __init__(self):
         self.person = None
+        self.token = None
+        self.zoobars = 0
 
     def checkLogin(self, username: str, password: str) -> Optional[str]:
         token = auth.login(username, password)
@@ -23,9 +35,6 @@ class User(object):
         self.setPerson(username, token)
         return "%s#%s" % (username, token)
 
-    def logout(self) -> None:
-        self.person = None
-
     def addRegistration(self, username: str, password: str) -> Optional[str]:
         token = auth.register(username, password)
         if token is not None:
@@ -41,14 +50,17 @@ class User(object):
             self.setPerson(username, token)
 
     def setPerson(self, username: str, token: str) -> None:
-        persondb = person_setup()
-        self.person = persondb.query(Person).get(username)
+        self.person = PersonRecord(username)
         self.token = token
         self.zoobars = bank.balance(username)
 
+    def record(self) -> UserRecord:
+        return UserRecord(self.person, self.token, self.zoobars)
+
 def logged_in() -> bool:
-    g.user = User()
-    g.user.checkCookie(request.cookies.get("PyZoobarLogin"))
+    user = User()
+    user.checkCookie(request.cookies.get("PyZoobarLogin"))
+    g.user = user.record()
     if g.user.person:
         return True
     else:
@@ -109,7 +121,7 @@ def login() -> Response:
 @catch_err
 def logout() -> Response:
     if logged_in():
-        g.user.logout()
+        g.user = g.user._replace(person=None)
     response = redirect(url_for('login'))
     response.set_cookie('PyZoobarLogin', '')
     return response
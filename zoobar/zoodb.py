@@ -13,7 +13,8 @@ class Person(PersonBase):
     password = Column(String(128))
     token = Column(String(128))
     zoobars = Column(Integer, nullable=False, default=10)
-    profile = Column(String(5000), nullable=False, default="")
+    ## Deferred: only loaded when a view actually reads person.profile.
+    profile = deferred(Column(String(5000), nullable=False, default=""))
 
 class Transfer(TransferBase):
     __tablename__ = "transfer"